@@ -2,13 +2,78 @@ import logging
 import os
 import codecs
 import re
+import sys
+import threading
+import multiprocessing
 from subprocess import Popen, PIPE
 from collections import OrderedDict
 
+from queue import Queue
+from sys import intern
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    from .bpe_fast import encode_ids
+except ImportError:
+    encode_ids = None
+
+try:
+    from sacremoses import MosesTokenizer
+except ImportError:
+    MosesTokenizer = None
+
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Note hardcoding of script locations within repo
+RESOURCES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
+
+
+class LRUCache(object):
+    """
+    A thread-safe bounded cache, the least recently used item is evicted when the cache is full
+
+    Args:
+      size: the maximum number of items in the cache
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """return the value for `key`, or None if it is not in the cache"""
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def keys(self):
+        with self.lock:
+            return list(self.items.keys())
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
 
 def remap_constraint_indices(tokenized_sequence, detokenized_sequence, constraint_indices):
     """
@@ -17,45 +82,44 @@ def remap_constraint_indices(tokenized_sequence, detokenized_sequence, constrain
     Any time there was '@@ ' in the tokenized sequence, we removed it
       - the detokenized sequence has fewer spaces than the tokenized sequence
     """
-    constraint_idx_starts = {start: end for start, end in constraint_indices}
-    constraint_idx_ends = {end: start for start, end in constraint_indices}
+    # constraint boundaries are walked with cursors over sorted lists, each list ends with a sentinel
+    starts = sorted(start for start, end in constraint_indices) + [sys.maxsize]
+    ends = sorted(end for start, end in constraint_indices) + [sys.maxsize]
+    start_cursor = 0
+    end_cursor = 0
 
     remapped_indices = []
     tokenized_idx = 0
-    current_offset = 0
     true_start = None
     for true_idx, output_char in enumerate(detokenized_sequence):
-        if tokenized_idx in constraint_idx_starts:
-            true_start = tokenized_idx - current_offset
-        elif tokenized_idx in constraint_idx_ends:
-            assert true_start is not None, 'if we found an end, we also need a start'
-            true_end = tokenized_idx - current_offset
-            remapped_indices.append([true_start, true_end])
-            true_start = None
         # this logic assumes that post-processing did not _change_ any characters
         # I.e. no characters were substituted for other characters
-        while output_char != tokenized_sequence[tokenized_idx]:
-            tokenized_idx += 1
-            current_offset += 1
-            if tokenized_idx > len(tokenized_sequence):
-                raise IndexError('We went beyond the end of the longer sequence: {}, when comparing with: {}'.format(
-                    tokenized_sequence,
-                    detokenized_sequence
-                ))
-
-            if tokenized_idx in constraint_idx_starts:
-                true_start = tokenized_idx - current_offset
-            elif tokenized_idx in constraint_idx_ends:
+        # the characters we skip over were removed by post-processing, so they all map to `true_idx`
+        match_idx = tokenized_sequence.find(output_char, tokenized_idx)
+        if match_idx == -1:
+            raise IndexError('We went beyond the end of the longer sequence: {}, when comparing with: {}'.format(
+                tokenized_sequence,
+                detokenized_sequence
+            ))
+
+        # handle every constraint boundary in [tokenized_idx, match_idx]
+        while min(starts[start_cursor], ends[end_cursor]) <= match_idx:
+            if starts[start_cursor] <= ends[end_cursor]:
+                # a start takes precedence over an end at the same index
+                if ends[end_cursor] == starts[start_cursor]:
+                    end_cursor += 1
+                start_cursor += 1
+                true_start = true_idx
+            else:
+                end_cursor += 1
                 assert true_start is not None, 'if we found an end, we also need a start'
-                true_end = tokenized_idx - current_offset
-                remapped_indices.append([true_start, true_end])
+                remapped_indices.append([true_start, true_idx])
                 true_start = None
 
-        tokenized_idx += 1
+        tokenized_idx = match_idx + 1
 
     if true_start is not None:
-        true_end = tokenized_idx - current_offset
-        remapped_indices.append([true_start, true_end])
+        remapped_indices.append([true_start, len(detokenized_sequence)])
 
     return remapped_indices
 
@@ -65,7 +129,9 @@ def convert_token_annotations_to_spans(token_sequence, constraint_annotations):
     # here we are just annotating which spans are constraints, we discard the constraint alignment information
 
     span_annotations = []
-    output_sequence = u''
+    # tokens are joined once at the end, `output_len` is the length of the sequence built so far
+    output_tokens = []
+    output_len = 0
     constraint_id = None
     constraint_start_idx = None
     for token, annotation in zip(token_sequence, constraint_annotations):
@@ -73,8 +139,8 @@ def convert_token_annotations_to_spans(token_sequence, constraint_annotations):
         if annotation is not None:
             if annotation[0] != constraint_id:
                 # we're starting a new constraint
-                constraint_start_idx = len(output_sequence)
-                if len(output_sequence) > 0:
+                constraint_start_idx = output_len
+                if output_len > 0:
                     # we'll add a whitespace before the constraint starts below
                     constraint_start_idx += 1
 
@@ -82,29 +148,21 @@ def convert_token_annotations_to_spans(token_sequence, constraint_annotations):
         else:
             # a constraint just finished
             if constraint_id is not None:
-                span_annotations.append([constraint_start_idx, len(output_sequence)])
+                span_annotations.append([constraint_start_idx, output_len])
                 constraint_id = None
                 constraint_start_idx = None
 
-        if len(output_sequence) == 0:
-            output_sequence = token
-        else:
-            output_sequence = u'{} {}'.format(output_sequence, token)
+        if len(output_tokens) > 0:
+            output_len += 1
+        output_tokens.append(token)
+        output_len += len(token)
 
+    output_sequence = u' '.join(output_tokens)
     return span_annotations, output_sequence
 
 
-def get_pairs(word):
-    """ (Subword Encoding) Return set of symbol pairs in a word.
-
-    word is represented as tuple of symbols (symbols being variable-length strings)
-    """
-    pairs = set()
-    prev_char = word[0]
-    for char in word[1:]:
-        pairs.add((prev_char, char))
-        prev_char = char
-    return pairs
+# rank of symbol pairs which are not in the merge table, the largest int32 so it fits in the compiled merge tables
+NO_MERGE = 2**31 - 1
 
 
 def encode(orig, bpe_codes, cache=None):
@@ -119,57 +177,237 @@ def encode(orig, bpe_codes, cache=None):
         return cache[orig]
 
     word = tuple(orig) + ('</w>',)
-    pairs = get_pairs(word)
 
-    while True:
-        bigram = min(pairs, key = lambda pair: bpe_codes.get(pair, float('inf')))
-        if bigram not in bpe_codes:
+    while len(word) > 1:
+        # find the first occurrence of the lowest-ranked bigram in a single scan
+        best_rank = NO_MERGE
+        best_idx = -1
+        for i in range(len(word) - 1):
+            rank = bpe_codes.get((word[i], word[i + 1]), NO_MERGE)
+            if rank < best_rank:
+                best_rank = rank
+                best_idx = i
+        if best_idx == -1:
             break
-        first, second = bigram
-        new_word = []
-        i = 0
+
+        # merge every occurrence of the bigram, starting from the first one
+        first, second = word[best_idx], word[best_idx + 1]
+        new_word = list(word[:best_idx])
+        i = best_idx
         while i < len(word):
-            try:
-                j = word.index(first, i)
-                new_word.extend(word[i:j])
-                i = j
-            except:
-                new_word.extend(word[i:])
-                break
-
-            if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                new_word.append(first+second)
+            if i < len(word) - 1 and word[i] == first and word[i + 1] == second:
+                new_word.append(intern(first + second))
                 i += 2
             else:
                 new_word.append(word[i])
                 i += 1
-        new_word = tuple(new_word)
-        word = new_word
-        if len(word) == 1:
-            break
-        else:
-            pairs = get_pairs(word)
+        word = tuple(new_word)
 
+    word = strip_end_of_word(word)
+
+    cache[orig] = word
+    return word
+
+
+def strip_end_of_word(word):
+    """ (Subword Encoding) Remove the end-of-word symbol from a tuple of subwords """
     # don't print end-of-word symbols
     if word[-1] == '</w>':
         word = word[:-1]
     elif word[-1].endswith('</w>'):
         word = word[:-1] + (word[-1].replace('</w>',''),)
-
-    cache[orig] = word
     return word
 
 
+# marks empty slots in the merge table, symbol ids are int32 so this is never a valid packed pair
+EMPTY_SLOT = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def hash_pair(packed):
+    """(Subword Encoding) splitmix64 finalizer, hashes packed (left_id, right_id) pairs"""
+    packed = (packed ^ (packed >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    packed = (packed ^ (packed >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return packed ^ (packed >> np.uint64(31))
+
+
+def build_merge_table(id_bpe_codes):
+    """
+    (Subword Encoding) Build an open-addressing hash table mapping symbol id pairs to merge ranks
+
+    Args:
+      id_bpe_codes: dict mapping (left_id, right_id) to the rank of that merge operation
+
+    Returns:
+      (table_keys, table_ranks): uint64 array of packed (left_id, right_id) keys, and int32 array of ranks
+    """
+    # the table size is a power of two, so that slots can be computed with a mask
+    size = 2
+    while size < 2 * len(id_bpe_codes):
+        size *= 2
+    mask = size - 1
+
+    table_keys = np.full(size, EMPTY_SLOT, dtype=np.uint64)
+    table_ranks = np.full(size, NO_MERGE, dtype=np.int32)
+    if len(id_bpe_codes) == 0:
+        return table_keys, table_ranks
+
+    pairs = np.array(list(id_bpe_codes.keys()), dtype=np.uint64)
+    packed = (pairs[:, 0] << np.uint64(32)) | pairs[:, 1]
+    slots = hash_pair(packed) & np.uint64(mask)
+    for key, slot, rank in zip(packed.tolist(), slots.tolist(), id_bpe_codes.values()):
+        # linear probing
+        while table_keys[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & mask
+        table_keys[slot] = key
+        table_ranks[slot] = rank
+
+    return table_keys, table_ranks
+
+
+def rank_of(table_keys, table_ranks, first, second):
+    """(Subword Encoding) Look up the rank of merging symbols `first` and `second`, NO_MERGE if there is none"""
+    packed = (np.uint64(first) << np.uint64(32)) | np.uint64(second)
+    mask = np.uint64(len(table_keys) - 1)
+    slot = hash_pair(packed) & mask
+    while True:
+        key = table_keys[slot]
+        if key == packed:
+            return table_ranks[slot]
+        if key == EMPTY_SLOT:
+            return NO_MERGE
+        slot = (slot + np.uint64(1)) & mask
+
+
+def merge_symbol_ids(ids, n, table_keys, table_ranks, merged_ids):
+    """
+    (Subword Encoding) Apply BPE merge operations in-place to the first `n` items of an int32 buffer of symbol ids
+
+    Args:
+      ids: int32 array of symbol ids, rewritten in place
+      n: the number of valid symbols in `ids`
+      table_keys: the keys of the merge table, see `build_merge_table`
+      table_ranks: the ranks of the merge table, see `build_merge_table`
+      merged_ids: int32 array mapping each merge rank to the id of the merged symbol
+
+    Returns:
+      the number of valid symbols in `ids` after all merges have been applied
+    """
+    while n > 1:
+        # find the first occurrence of the lowest-ranked bigram in a single scan
+        best_rank = NO_MERGE
+        best_idx = -1
+        for i in range(n - 1):
+            rank = rank_of(table_keys, table_ranks, ids[i], ids[i + 1])
+            if rank < best_rank:
+                best_rank = rank
+                best_idx = i
+        if best_idx == -1:
+            break
+
+        # merge every occurrence of the bigram, starting from the first one
+        first = ids[best_idx]
+        second = ids[best_idx + 1]
+        merged = merged_ids[best_rank]
+        i = best_idx
+        j = best_idx
+        while i < n:
+            if i < n - 1 and ids[i] == first and ids[i + 1] == second:
+                ids[j] = merged
+                i += 2
+            else:
+                ids[j] = ids[i]
+                i += 1
+            j += 1
+        n = j
+
+    return n
+
+
+if njit is not None:
+    hash_pair = njit(cache=True)(hash_pair)
+    rank_of = njit(cache=True)(rank_of)
+    merge_symbol_ids = njit(cache=True)(merge_symbol_ids)
+
+
 class BPE(object):
 
-    def __init__(self, codes, separator='@@', ignore=None):
-        self.bpe_codes = [tuple(item.split()) for item in codes]
+    def __init__(self, codes, separator='@@', ignore=None, cache_size=2**16, max_token_len_cache=64):
         self.ignore = ignore
 
-        # some hacking to deal with duplicates (only consider first instance)
-        self.bpe_codes = dict([(code, i) for (i, code) in reversed(list(enumerate(self.bpe_codes)))])
+        # LRU cache of segmented words, very long words are not cached to bound memory
+        self.cache = LRUCache(cache_size)
+        self.max_token_len_cache = max_token_len_cache
+
+        # for duplicates, only consider the first instance
+        self.bpe_codes = {}
+        for i, item in enumerate(codes):
+            # subwords are interned, so that equal subwords are the same object and hash only once
+            self.bpe_codes.setdefault(tuple(intern(subword) for subword in item.split()), i)
         self.separator = separator
 
+        # if the cython extension or numba is available, we segment words with a compiled kernel which works on
+        # integer symbol ids
+        self.use_symbol_ids = encode_ids is not None or njit is not None
+        if self.use_symbol_ids:
+            self._build_symbol_ids()
+
+    def _build_symbol_ids(self):
+        """map every subword in the merge table to a stable int id, and build a hash table of (id, id) -> rank"""
+        self.symbol_ids = {u'</w>': 0}
+        self.symbols = [u'</w>']
+
+        def symbol_id(symbol):
+            if symbol not in self.symbol_ids:
+                self.symbol_ids[symbol] = len(self.symbols)
+                self.symbols.append(symbol)
+            return self.symbol_ids[symbol]
+
+        id_bpe_codes = {}
+        self.merged_ids = np.full(max(self.bpe_codes.values()) + 1 if self.bpe_codes else 0, -1, dtype=np.int32)
+        for code, rank in sorted(self.bpe_codes.items(), key=lambda item: item[1]):
+            if len(code) != 2:
+                continue
+            first, second = code
+            id_bpe_codes[(symbol_id(first), symbol_id(second))] = rank
+            self.merged_ids[rank] = symbol_id(first + second)
+
+        self.merge_table_keys, self.merge_table_ranks = build_merge_table(id_bpe_codes)
+
+    def _encode_ids(self, orig):
+        """(Subword Encoding) Encode a word with the compiled merge kernel"""
+        # characters which never occur in the merge table can't be merged, so they get an id past the end
+        # of the symbol table which encodes their position in the original word
+        num_symbols = len(self.symbols)
+        symbol_ids = self.symbol_ids
+        ids = np.array([symbol_ids.get(char, num_symbols + i) for i, char in enumerate(orig)] + [symbol_ids[u'</w>']],
+                       dtype=np.int32)
+
+        if encode_ids is not None:
+            n = encode_ids(ids, len(ids), self.merge_table_keys, self.merge_table_ranks, self.merged_ids)
+        else:
+            n = merge_symbol_ids(ids, len(ids), self.merge_table_keys, self.merge_table_ranks, self.merged_ids)
+
+        # iterate over python ints rather than numpy scalars
+        symbols = self.symbols
+        word = tuple(symbols[i] if i < num_symbols else orig[i - num_symbols] for i in ids[:n].tolist())
+        return strip_end_of_word(word)
+
+    def encode(self, word):
+        """(Subword Encoding) Encode a single word, returns a tuple of subwords"""
+        new_word = self.cache.get(word)
+        if new_word is not None:
+            return new_word
+
+        if self.use_symbol_ids:
+            new_word = self._encode_ids(word)
+        else:
+            new_word = encode(word, self.bpe_codes)
+
+        if len(word) <= self.max_token_len_cache:
+            self.cache.put(word, new_word)
+
+        return new_word
+
     def segment(self, sentence):
         """segment single sentence (whitespace-tokenized string) with BPE encoding"""
 
@@ -178,7 +416,7 @@ class BPE(object):
             if self.ignore is not None and word in self.ignore:
                 output.append(word)
             else:
-                new_word = encode(word, self.bpe_codes)
+                new_word = self.encode(word)
 
                 for item in new_word[:-1]:
                     output.append(item + self.separator)
@@ -187,37 +425,70 @@ class BPE(object):
         return u' '.join(output)
 
 
+# BPE objects are shared by all DataProcessors which use the same subword codes
+_bpe_cache = {}
+_bpe_cache_lock = threading.Lock()
+
+
+def load_bpe(subword_codes):
+    """Load a BPE object from a file of subword codes, each file is only read once"""
+    path = os.path.abspath(subword_codes)
+    with _bpe_cache_lock:
+        if path not in _bpe_cache:
+            with codecs.open(path, encoding='utf-8') as subword_codes_iter:
+                _bpe_cache[path] = BPE(subword_codes_iter)
+        return _bpe_cache[path]
+
+
 class DataProcessor(object):
     """
     This class encapusulates pre- and post-processing functionality
 
+    Tokenization uses either the moses `tokenizer.perl` script (tokenizer_backend='moses'), or the python port of
+    the same tokenizer in `sacremoses` (tokenizer_backend='sacremoses'), which avoids the subprocess round-trip
+
     """
 
-    def __init__(self, lang, use_subword=False, subword_codes=None, escape_special_chars=False, truecase_model=None):
+    def __init__(self, lang, use_subword=False, subword_codes=None, escape_special_chars=False, truecase_model=None,
+                 pool_size=None, cache_size=4096, tokenizer_backend='moses'):
         self.use_subword = use_subword
         if self.use_subword:
-            subword_codes_iter = codecs.open(subword_codes, encoding='utf-8')
-            self.bpe = BPE(subword_codes_iter)
+            self.bpe = load_bpe(subword_codes)
 
         self.lang = lang
 
-        # Note hardcoding of script location within repo
-        tokenize_script = os.path.join(os.path.dirname(__file__), 'resources/tokenizer/tokenizer.perl')
-        self.tokenizer_cmd = [tokenize_script, '-l', self.lang, '-no-escape', '1', '-q', '-', '-b']
-        self.tokenizer = Popen(self.tokenizer_cmd, stdin=PIPE, stdout=PIPE, bufsize=1)
-
-        detokenize_script = os.path.join(os.path.dirname(__file__), 'resources/tokenizer/detokenizer.perl')
+        assert tokenizer_backend in ('moses', 'sacremoses'), 'Unknown tokenizer backend: {}'.format(tokenizer_backend)
+        self.tokenizer_backend = tokenizer_backend
+        if self.tokenizer_backend == 'sacremoses':
+            if MosesTokenizer is None:
+                raise ImportError('tokenizer_backend=\'sacremoses\' requires the sacremoses package')
+            self.moses_tokenizer = MosesTokenizer(lang=self.lang)
+            self.tokenizers = []
+        else:
+            tokenize_script = os.path.join(RESOURCES_DIR, 'tokenizer/tokenizer.perl')
+            self.tokenizer_cmd = [tokenize_script, '-l', self.lang, '-no-escape', '1', '-q', '-', '-b']
+
+            # a pool of tokenizer processes, so that concurrent requests don't block on a single pipe
+            if pool_size is None:
+                pool_size = multiprocessing.cpu_count()
+            self.tokenizers = [self._start_tokenizer() for _ in range(pool_size)]
+            self.tokenizer_pool = Queue()
+            for tokenizer in self.tokenizers:
+                self.tokenizer_pool.put(tokenizer)
+
+        detokenize_script = os.path.join(RESOURCES_DIR, 'tokenizer/detokenizer.perl')
         self.detokenizer_cmd = [detokenize_script, '-l', self.lang, '-q', '-']
 
         self.escape_special_chars = escape_special_chars
 
+        # tokenization is deterministic, so we cache the tokens of recently seen segments
+        self.tokenize_cache = LRUCache(cache_size)
+
         if self.escape_special_chars:
-            escape_special_chars_script = os.path.join(os.path.dirname(__file__),
-                                                       'resources/tokenizer/escape-special-chars.perl')
+            escape_special_chars_script = os.path.join(RESOURCES_DIR, 'tokenizer/escape-special-chars.perl')
             self.escape_special_chars_cmd = [escape_special_chars_script]
 
-            deescape_special_chars_script = os.path.join(os.path.dirname(__file__),
-                                                         'resources/tokenizer/deescape-special-chars.perl')
+            deescape_special_chars_script = os.path.join(RESOURCES_DIR, 'tokenizer/deescape-special-chars.perl')
             self.deescape_special_chars_cmd = [deescape_special_chars_script]
 
         # make quicker escape/descape implementation
@@ -238,44 +509,138 @@ class DataProcessor(object):
         if truecase_model is not None:
             self.truecase = True
 
-            truecase_script = os.path.join(os.path.dirname(__file__),
-                                           'resources/recaser/truecase.perl')
+            truecase_script = os.path.join(RESOURCES_DIR, 'recaser/truecase.perl')
             self.truecase_cmd = [truecase_script, '-m', truecase_model]
 
-            detruecase_script = os.path.join(os.path.dirname(__file__),
-                                             'resources/recaser/detruecase.perl')
+            detruecase_script = os.path.join(RESOURCES_DIR, 'recaser/detruecase.perl')
             self.detruecase_cmd = [detruecase_script]
 
-    def tokenize(self, text):
-        if len(text.strip()) == 0:
-            return []
+    def tokenize(self, text, truecase=None):
+        return self.tokenize_batch([text], truecase=truecase)[0]
+
+    def tokenize_batch(self, texts, truecase=None):
+        """
+        Tokenize a list of strings, writing the whole batch to the moses tokenizer at once
+
+        Args:
+          texts: a list of strings, each string is one segment
+          truecase: (Optional) overrides `self.truecase` for this batch
+
+        Returns:
+          a list with one list of tokens for each input string
+        """
+        if truecase is None:
+            truecase = self.truecase
+
+        all_tokens = [[] for _ in texts]
+        batch_idxs = []
+        for i, text in enumerate(texts):
+            # empty segments are not sent to the tokenizer
+            if len(text.strip()) == 0:
+                continue
+            cached_tokens = self.tokenize_cache.get((text, truecase))
+            if cached_tokens is not None:
+                all_tokens[i] = list(cached_tokens)
+            else:
+                batch_idxs.append(i)
 
-        if type(text) is unicode:
-            text = text.encode('utf8')
-        self.tokenizer.stdin.write(text + '\n\n')
-        self.tokenizer.stdin.flush()
-        self.tokenizer.stdout.flush()
+        if len(batch_idxs) == 0:
+            return all_tokens
 
-        # this logic is due to issues with calling out to the moses tokenizer
-        segment = '\n'
-        while segment == '\n':
-            segment = self.tokenizer.stdout.readline()
-        # read one more line
-        _ = self.tokenizer.stdout.readline()
-        segment = segment.rstrip()
+        if self.tokenizer_backend == 'sacremoses':
+            segments = [self._sacremoses_tokenize(texts[i]) for i in batch_idxs]
+        else:
+            segments = self._perl_tokenize([texts[i] for i in batch_idxs])
+
+        for i, segment in zip(batch_idxs, segments):
+            all_tokens[i] = self._process_tokenized_segment(segment, truecase)
+            self.tokenize_cache.put((texts[i], truecase), tuple(all_tokens[i]))
+        return all_tokens
+
+    def _sacremoses_tokenize(self, text):
+        return u' '.join(self.moses_tokenizer.tokenize(text, escape=False, return_str=False))
+
+    def _perl_tokenize(self, texts):
+        """write a batch of segments to one of the moses tokenizer processes, return one line for each segment"""
+        # the tokenizer is line-based, so each segment must be a single line
+        batch = b'\n'.join(text.replace(u'\n', u' ').encode('utf-8', 'surrogatepass') for text in texts)
+
+        tokenizer = self.tokenizer_pool.get()
+        writer = None
+        try:
+            # the tokenizer writes output while it reads input, so a batch larger than the pipe buffers would
+            # deadlock if we wrote all of it before reading -- stdin is fed from a separate thread instead
+            write_errors = []
+
+            def write_batch():
+                try:
+                    tokenizer.stdin.write(batch + b'\n\n')
+                    tokenizer.stdin.flush()
+                except (IOError, OSError) as e:
+                    write_errors.append(e)
+
+            writer = threading.Thread(target=write_batch)
+            writer.daemon = True
+            writer.start()
+
+            # the tokenizer writes exactly one line for each input line, blank lines included (e.g. for a segment
+            # of control characters), so we read one line per segment and then the line for the trailing blank
+            segments = []
+            for _ in range(len(texts) + 1):
+                segment = tokenizer.stdout.readline()
+                if len(segment) == 0:
+                    raise IOError('The moses tokenizer exited before tokenizing the whole batch')
+                segments.append(segment.rstrip())
+            segments.pop()
+
+            writer.join()
+            if len(write_errors) > 0:
+                raise write_errors[0]
+        except BaseException:
+            # the tokenizer is dead or out of sync with its pipes, so it is replaced by a fresh process
+            self._stop_tokenizer(tokenizer, writer)
+            new_tokenizer = self._start_tokenizer()
+            self.tokenizers[self.tokenizers.index(tokenizer)] = new_tokenizer
+            self.tokenizer_pool.put(new_tokenizer)
+            raise
+
+        self.tokenizer_pool.put(tokenizer)
+        return [segment.decode('utf-8', 'surrogatepass') for segment in segments]
+
+    def _start_tokenizer(self):
+        return Popen(self.tokenizer_cmd, stdin=PIPE, stdout=PIPE)
+
+    @staticmethod
+    def _stop_tokenizer(tokenizer, writer=None):
+        """kill a moses tokenizer process and close its pipes, after the thread writing to it has finished"""
+        if tokenizer.poll() is None:
+            tokenizer.kill()
+        if writer is not None:
+            writer.join()
+        tokenizer.wait()
+        for pipe in (tokenizer.stdin, tokenizer.stdout):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
 
+    def close(self):
+        """stop the moses tokenizer processes, the processor can't tokenize with the moses backend afterwards"""
+        for tokenizer in self.tokenizers:
+            self._stop_tokenizer(tokenizer)
+
+    def _process_tokenized_segment(self, segment, truecase):
+        """escape, truecase and segment a single line of output from the moses tokenizer"""
         if self.escape_special_chars:
-            segment = segment.decode('utf8')
             for k, v in self.special_token_map.items():
                 segment = re.sub(re.escape(k), v, segment)
-            segment.encode('utf8')
 
             # char_escape = Popen(self.escape_special_chars_cmd, stdin=PIPE, stdout=PIPE)
             # this script cuts off a whitespace, so we add some extra
             # segment, _ = char_escape.communicate(segment + '   ')
             # segment = segment.rstrip()
 
-        if self.truecase:
+        if truecase and len(segment) > 0:
             # hack to make this faster
             segment = segment[0].lower() + segment[1:]
             # truecaser = Popen(self.truecase_cmd, stdin=PIPE, stdout=PIPE)
@@ -283,15 +648,10 @@ class DataProcessor(object):
             # segment, _ = truecaser.communicate(segment + '   ')
             # segment = segment.rstrip()
 
-        if type(segment) is not unicode:
-            utf_line = segment.decode('utf8')
-        else:
-            utf_line = segment
-
         if self.use_subword:
-            tokens = self.bpe.segment(utf_line).split()
+            tokens = self.bpe.segment(segment).split()
         else:
-            tokens = utf_line.split()
+            tokens = segment.split()
         return tokens
 
     def detokenize(self, text):
@@ -304,16 +664,13 @@ class DataProcessor(object):
 
         """
         if self.use_subword:
-            text = re.sub("\@\@ ", "", text)
-            text = re.sub("\@\@", "", text)
-
-        if type(text) is unicode:
-            text = text.encode('utf8')
+            text = re.sub(r"@@ ", "", text)
+            text = re.sub(r"@@", "", text)
 
         detokenizer = Popen(self.detokenizer_cmd, stdin=PIPE, stdout=PIPE)
-        text, _ = detokenizer.communicate(text)
+        text, _ = detokenizer.communicate(text.encode('utf-8', 'surrogatepass'))
 
-        utf_line = text.rstrip().decode('utf8')
+        utf_line = text.rstrip().decode('utf-8', 'surrogatepass')
         return utf_line
 
     def deescape_special_chars(self, text):
@@ -343,4 +700,3 @@ class DataProcessor(object):
         # text = text.rstrip()
         # utf_line = text.decode('utf8')
         # return utf_line
-
@@ -0,0 +1,83 @@
+# cython: language_level=3
+"""
+(Subword Encoding) Compiled BPE merge kernel, the same algorithm as `constrained_decoding.server.merge_symbol_ids`
+
+Build with `python setup.py build_ext --inplace`
+"""
+cimport cython
+from libc.stdint cimport int32_t, uint32_t, uint64_t, INT32_MAX, UINT64_MAX
+
+
+cdef inline uint64_t hash_pair(uint64_t packed) nogil:
+    # splitmix64 finalizer
+    packed = (packed ^ (packed >> 30)) * 0xbf58476d1ce4e5b9ULL
+    packed = (packed ^ (packed >> 27)) * 0x94d049bb133111ebULL
+    return packed ^ (packed >> 31)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int32_t rank_of(uint64_t[::1] table_keys, int32_t[::1] table_ranks,
+                            int32_t first, int32_t second) nogil:
+    cdef uint64_t packed = (<uint64_t><uint32_t>first << 32) | <uint32_t>second
+    cdef uint64_t mask = table_keys.shape[0] - 1
+    cdef uint64_t slot = hash_pair(packed) & mask
+    cdef uint64_t key
+    while True:
+        key = table_keys[slot]
+        if key == packed:
+            return table_ranks[slot]
+        if key == UINT64_MAX:
+            return INT32_MAX
+        slot = (slot + 1) & mask
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def encode_ids(int32_t[::1] ids, int n, uint64_t[::1] table_keys, int32_t[::1] table_ranks,
+               int32_t[::1] merged_ids):
+    """
+    Apply BPE merge operations in-place to the first `n` items of an int32 buffer of symbol ids
+
+    Args:
+      ids: int32 array of symbol ids, rewritten in place
+      n: the number of valid symbols in `ids`
+      table_keys: the keys of the merge table, see `constrained_decoding.server.build_merge_table`
+      table_ranks: the ranks of the merge table, see `constrained_decoding.server.build_merge_table`
+      merged_ids: int32 array mapping each merge rank to the id of the merged symbol
+
+    Returns:
+      the number of valid symbols in `ids` after all merges have been applied
+    """
+    cdef int i, j, best_idx
+    cdef int32_t rank, best_rank, first, second, merged
+
+    while n > 1:
+        # find the first occurrence of the lowest-ranked bigram in a single scan
+        best_rank = INT32_MAX
+        best_idx = -1
+        for i in range(n - 1):
+            rank = rank_of(table_keys, table_ranks, ids[i], ids[i + 1])
+            if rank < best_rank:
+                best_rank = rank
+                best_idx = i
+        if best_idx == -1:
+            break
+
+        # merge every occurrence of the bigram, starting from the first one
+        first = ids[best_idx]
+        second = ids[best_idx + 1]
+        merged = merged_ids[best_rank]
+        i = best_idx
+        j = best_idx
+        while i < n:
+            if i < n - 1 and ids[i] == first and ids[i + 1] == second:
+                ids[j] = merged
+                i += 2
+            else:
+                ids[j] = ids[i]
+                i += 1
+            j += 1
+        n = j
+
+    return n
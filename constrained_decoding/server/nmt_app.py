@@ -1,6 +1,6 @@
 import logging
-import copy
 import json
+import threading
 from flask import Flask, request, jsonify, abort
 
 import pylru
@@ -18,6 +18,7 @@ app.models = None
 
 cache_size = 1000
 app.local_cache = pylru.lrucache(cache_size)
+app.local_cache_lock = threading.Lock()
 
 
 # TODO: multiple instances of the same model, delegate via thread queue? -- with Flask this is way too buggy
@@ -32,22 +33,24 @@ def constrained_decoding_endpoint():
     
     beam_size = 1
 
-    if (source_lang, target_lang) not in app.models:
-        logger.error('MT Server does not have a model for: {}'.format((source_lang, target_lang)))
+    model_key = (source_lang, target_lang)
+    if model_key not in app.models:
+        logger.error('MT Server does not have a model for: {}'.format(model_key))
         abort(404)
 
     source_sentence = request_data['source_sentence']
     target_constraints = request_data.get('target_constraints', None)
 
-    model = app.models[(source_lang, target_lang)]
-    decoder = app.decoders[(source_lang, target_lang)]
+    model = app.models[model_key]
+    decoder = app.decoders[model_key]
 
-    cache_obj = copy.deepcopy(request_data)
-    del cache_obj['request_time']
+    # the request time changes on every request, so it isn't part of the cache key
+    cache_obj = {k: v for k, v in request_data.items() if k != 'request_time'}
     cache_str = json.dumps(cache_obj)
-    if cache_str in app.local_cache:
-        logger.info('Cache hit: {}'.format(cache_str))
-        return app.local_cache[cache_str]
+    with app.local_cache_lock:
+        if cache_str in app.local_cache:
+            logger.info('Cache hit: {}'.format(cache_str))
+            return app.local_cache[cache_str]
 
     # Note: remember we support multiple inputs for each model (i.e. each model may be an ensemble where sub-models
     # Note: accept different inputs)
@@ -63,17 +66,15 @@ def constrained_decoding_endpoint():
     if target_constraints is not None:
         if target_data_processor is not None:
             # hack to avoid truecasing constraints
-            temp_truecase = target_data_processor.truecase
-            target_data_processor.truecase = False
-            target_constraints = [target_data_processor.tokenize(c) for c in target_constraints]
-            target_data_processor.truecase = temp_truecase
+            target_constraints = target_data_processor.tokenize_batch(target_constraints, truecase=False)
 
     logger.info('decode')
     # Note best_hyps is always a list
-    best_outputs = decode(source_sentence,  model, decoder,
-                          constraints=target_constraints, n_best=n_best, beam_size=beam_size)
-
-    target_data_processor = app.processors.get(target_lang, None)
+    # the model's theano functions reuse their input and output storage, so only one request can decode with a model
+    # at a time -- tokenization above still runs concurrently
+    with app.decoder_locks[model_key]:
+        best_outputs = decode(source_sentence,  model, decoder,
+                              constraints=target_constraints, n_best=n_best, beam_size=beam_size)
 
     # each output is (seq, score, true_len, hypothesis)
     output_objects = []
@@ -115,7 +116,8 @@ def constrained_decoding_endpoint():
                                'score': score})
 
     output_json = jsonify({'outputs': output_objects})
-    app.local_cache[cache_str] = output_json
+    with app.local_cache_lock:
+        app.local_cache[cache_str] = output_json
 
     return output_json
 
@@ -168,7 +170,18 @@ def decode(source_sentence, model, decoder,
 
 
 # Note: this function will break libgpuarray if theano is using the GPU
-def run_imt_server(models, processors=None, port=5007):
+def run_imt_server(models, processors=None, port=5007, wsgi_server='flask', threads=8):
+    """
+    Start the server
+
+    Args:
+      models: dict mapping (source_lang, target_lang) tuples to translation models
+      processors: (Optional) dict mapping languages to `DataProcessor` instances
+      port: the port to listen on
+      wsgi_server: 'flask' for the development server, or 'waitress' for a production WSGI server
+      threads: the number of request threads used by waitress, requests for the same model still decode one at a
+        time, see `app.decoder_locks`
+    """
     # Note: servers use a special .yaml config format-- maps language pairs to NMT configuration files
     # the server instantiates a predictor for each config, and hashes them by language pair tuples -- i.e. (en,fr)
     # Caller passes in a dict of predictors, keys are tuples (source_lang, target_lang)
@@ -179,9 +192,12 @@ def run_imt_server(models, processors=None, port=5007):
 
     app.models = models
     app.decoders = {k: create_constrained_decoder(v) for k, v in models.items()}
+    app.decoder_locks = {k: threading.Lock() for k in models.keys()}
 
     logger.info('Server starting on port: {}'.format(port))
     # logger.info('navigate to: http://localhost:{}/neural_MT_demo to see the system demo'.format(port))
-    # app.run(debug=True, port=port, host='127.0.0.1', threaded=True)
-    app.run(debug=False, port=port, host='127.0.0.1', threaded=False)
-
+    if wsgi_server == 'waitress':
+        from waitress import serve
+        serve(app, host='127.0.0.1', port=port, threads=threads)
+    else:
+        app.run(debug=False, port=port, host='127.0.0.1', threaded=True)
@@ -41,6 +41,13 @@ if __name__ == '__main__':
     parser.add_argument('--escape_special_chars', dest='escape_special_chars', action='store_true',
                         help='(Optional) if --escape_special_chars, we will map special punctuation to html entities')
     parser.set_defaults(escape_special_chars=False)
+    parser.add_argument('--tokenizer_backend', default='moses', choices=['moses', 'sacremoses'],
+                        help='(Optional) tokenize with the moses perl script, or with the sacremoses python port')
+    parser.add_argument('--wsgi_server', default='flask', choices=['flask', 'waitress'],
+                        help='(Optional) serve with the flask development server, or with waitress')
+    parser.add_argument('--threads', default=8, type=int,
+                        help='(Optional) the number of request threads when using waitress, '
+                             'decoding with each model is still serialized')
     args = parser.parse_args()
 
     assert len(args.models) == len(args.configs), 'Number of models differs from numer of config files'
@@ -51,11 +58,13 @@ if __name__ == '__main__':
     src_data_processor = DataProcessor(lang=args.source_lang, use_subword=True,
                                        subword_codes=args.source_subword_codes,
                                        truecase_model=args.source_truecase,
-                                       escape_special_chars=args.escape_special_chars)
+                                       escape_special_chars=args.escape_special_chars,
+                                       tokenizer_backend=args.tokenizer_backend)
     trg_data_processor = DataProcessor(lang=args.target_lang, use_subword=True,
                                        subword_codes=args.target_subword_codes,
                                        truecase_model=args.target_truecase,
-                                       escape_special_chars=args.escape_special_chars)
+                                       escape_special_chars=args.escape_special_chars,
+                                       tokenizer_backend=args.tokenizer_backend)
 
     configs = [load_config(f) for f in args.configs]
 
@@ -68,7 +77,7 @@ if __name__ == '__main__':
         args.target_lang: trg_data_processor
     }
 
-    run_imt_server(models=model_dict, processors=processor_dict)
+    run_imt_server(models=model_dict, processors=processor_dict, wsgi_server=args.wsgi_server, threads=args.threads)
 
 
 
@@ -3,6 +3,16 @@
 import os
 import setuptools
 
+# the compiled BPE kernel is optional, the server falls back to numba or pure python if it isn't built
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([
+        setuptools.Extension('constrained_decoding.server.bpe_fast',
+                             ['constrained_decoding/server/bpe_fast.pyx'])
+    ])
+except ImportError:
+    ext_modules = []
+
 setuptools.setup(
     name='constrained_decoding',
     version='0.1',
@@ -18,5 +28,18 @@ setuptools.setup(
     install_requires=[
         'sortedcontainers'
     ],
-    packages=['constrained_decoding'],
+    extras_require={
+        # compiled BPE segmentation for the server
+        'numba': ['numba'],
+        # python tokenizer for the server, see `DataProcessor`
+        'sacremoses': ['sacremoses'],
+        # production WSGI server for `run_imt_server`
+        'waitress': ['waitress']
+    },
+    packages=['constrained_decoding', 'constrained_decoding.server'],
+    # the moses perl scripts used by `constrained_decoding.server.DataProcessor`
+    package_data={
+        'constrained_decoding.server': ['resources/*/*.perl', 'resources/share/nonbreaking_prefixes/*']
+    },
+    ext_modules=ext_modules,
 )
@@ -0,0 +1,77 @@
+# coding: utf-8
+import codecs
+import os
+import shutil
+import tempfile
+import unittest
+
+from constrained_decoding.server import BPE, encode, load_bpe
+
+
+class TestBPE(unittest.TestCase):
+
+    def setUp(self):
+        self.codes = [
+            u'l o',
+            u'lo w',
+            u'e r',
+            u'er </w>',
+            u't h',
+            u'th e',
+            u'e s',
+            u'es t',
+            u'est </w>',
+            u'low er</w>',
+            # duplicates are ignored
+            u'l o',
+        ]
+
+    def test_encode(self):
+        bpe = BPE(self.codes)
+        self.assertEqual(encode(u'lower', bpe.bpe_codes), (u'lower',))
+        self.assertEqual(encode(u'lowest', bpe.bpe_codes), (u'low', u'est'))
+        self.assertEqual(encode(u'thee', bpe.bpe_codes), (u'the', u'e'))
+        self.assertEqual(encode(u'xyz', bpe.bpe_codes), (u'x', u'y', u'z'))
+
+    def test_segment(self):
+        bpe = BPE(self.codes)
+        self.assertEqual(bpe.segment(u'the lowest newer'), u'the low@@ est n@@ e@@ w@@ er')
+
+    def test_cache(self):
+        bpe = BPE(self.codes, cache_size=2, max_token_len_cache=6)
+        self.assertEqual(bpe.segment(u'lowest lower thee'), u'low@@ est lower the@@ e')
+        # the least recently used word was evicted
+        self.assertEqual(bpe.cache.keys(), [u'lower', u'thee'])
+
+        self.assertEqual(bpe.encode(u'lower'), (u'lower',))
+        self.assertEqual(bpe.cache.keys(), [u'thee', u'lower'])
+
+        # words longer than max_token_len_cache are not cached
+        self.assertEqual(bpe.encode(u'lowerlower'), (u'low', u'er', u'lower'))
+        self.assertNotIn(u'lowerlower', bpe.cache)
+
+    def test_load_bpe(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            codes_file = os.path.join(temp_dir, 'codes.bpe')
+            with codecs.open(codes_file, 'w', encoding='utf-8') as out:
+                out.write(u'\n'.join(self.codes) + u'\n')
+
+            bpe = load_bpe(codes_file)
+            self.assertEqual(bpe.segment(u'the lowest'), u'the low@@ est')
+            # each file is only loaded once
+            self.assertIs(load_bpe(os.path.join(temp_dir, '.', 'codes.bpe')), bpe)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_symbol_id_segmentation_matches_encode(self):
+        bpe = BPE(self.codes)
+        if not bpe.use_symbol_ids:
+            self.skipTest('numba is not available')
+
+        for word in [u'lower', u'lowest', u'lolololo', u'thethe', u'erer', u'ß', u'löwer', u'e', u'tttthhhh']:
+            self.assertEqual(bpe._encode_ids(word), encode(word, bpe.bpe_codes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# coding: utf-8
+import unittest
+from shutil import which
+
+from constrained_decoding.server import DataProcessor, MosesTokenizer
+
+
+@unittest.skipIf(which('perl') is None, 'the moses scripts require perl')
+class TestDataProcessor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.processor = DataProcessor(lang='en', pool_size=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.processor.close()
+
+    def test_tokenize(self):
+        self.assertEqual(self.processor.tokenize(u'Hello, world!'), [u'Hello', u',', u'world', u'!'])
+        self.assertEqual(self.processor.tokenize(u'   '), [])
+
+    def test_tokenize_batch(self):
+        self.assertEqual(self.processor.tokenize_batch([u'Süß (test)', u'', u'It\'s fine.']),
+                         [[u'Süß', u'(', u'test', u')'], [], [u'It', u'\'s', u'fine', u'.']])
+
+    def test_tokenize_batch_larger_than_pipe_buffers(self):
+        # regression test: writing the whole batch before reading used to deadlock once the batch filled the pipes
+        texts = [u'This is segment number {}, which is long enough.'.format(i) for i in range(4000)]
+        self.assertGreater(sum(len(text) for text in texts), 128 * 1024)
+
+        all_tokens = self.processor.tokenize_batch(texts)
+        self.assertEqual(len(all_tokens), len(texts))
+        self.assertEqual(all_tokens[-1], [u'This', u'is', u'segment', u'number', u'3999', u',', u'which', u'is',
+                                          u'long', u'enough', u'.'])
+
+    def test_tokenize_batch_keeps_segments_aligned(self):
+        # regression test: a segment which the tokenizer turns into a blank line used to shift every later segment
+        self.assertEqual(self.processor.tokenize_batch([u'a b', u'\x01\x02', u'c d.']),
+                         [[u'a', u'b'], [], [u'c', u'd', u'.']])
+        self.assertEqual(self.processor.tokenize(u'Hello, world!'), [u'Hello', u',', u'world', u'!'])
+
+    def test_failed_tokenizer_is_replaced(self):
+        processor = DataProcessor(lang='en', pool_size=1)
+        self.addCleanup(processor.close)
+        dead_tokenizer = processor.tokenizers[0]
+        dead_tokenizer.kill()
+        dead_tokenizer.wait()
+
+        with self.assertRaises(IOError):
+            processor.tokenize(u'Hello, world!')
+        self.assertIsNot(processor.tokenizers[0], dead_tokenizer)
+        self.assertEqual(processor.tokenize(u'Hello, world!'), [u'Hello', u',', u'world', u'!'])
+
+    def test_close(self):
+        processor = DataProcessor(lang='en', pool_size=2)
+        processor.close()
+        self.assertTrue(all(tokenizer.poll() is not None for tokenizer in processor.tokenizers))
+
+    def test_detokenize(self):
+        self.assertEqual(self.processor.detokenize(u'Hello , world !'), u'Hello, world!')
+
+
+@unittest.skipIf(which('perl') is None, 'the moses scripts require perl')
+class TestTokenizeCache(unittest.TestCase):
+
+    def setUp(self):
+        # the truecase model isn't read, it only switches on the lowercasing of the first character
+        self.processor = DataProcessor(lang='en', pool_size=1, truecase_model='unused')
+        self.addCleanup(self.processor.close)
+
+        # record every segment that is sent to the tokenizer
+        self.sent_texts = []
+        perl_tokenize = self.processor._perl_tokenize
+
+        def recording_perl_tokenize(texts):
+            self.sent_texts.extend(texts)
+            return perl_tokenize(texts)
+
+        self.processor._perl_tokenize = recording_perl_tokenize
+
+    def test_repeated_segment_is_not_tokenized_again(self):
+        first = self.processor.tokenize_batch([u'Hello, world!', u'Goodbye.'])
+        second = self.processor.tokenize_batch([u'Goodbye.', u'Hello, world!', u'New segment'])
+        self.assertEqual(second[:2], first[::-1])
+        self.assertEqual(self.sent_texts, [u'Hello, world!', u'Goodbye.', u'New segment'])
+
+    def test_truecase_is_part_of_the_cache_key(self):
+        self.assertEqual(self.processor.tokenize(u'Hello world'), [u'hello', u'world'])
+        self.assertEqual(self.processor.tokenize(u'Hello world', truecase=False), [u'Hello', u'world'])
+        self.assertEqual(self.processor.tokenize(u'Hello world'), [u'hello', u'world'])
+        self.assertEqual(self.sent_texts, [u'Hello world', u'Hello world'])
+
+    def test_cached_tokens_are_copied(self):
+        tokens = self.processor.tokenize(u'Hello world')
+        tokens.append(u'!')
+        cached_tokens = self.processor.tokenize(u'Hello world')
+        self.assertIsInstance(cached_tokens, list)
+        self.assertEqual(cached_tokens, [u'hello', u'world'])
+        self.assertIsNot(cached_tokens, self.processor.tokenize(u'Hello world'))
+        self.assertEqual(self.sent_texts, [u'Hello world'])
+
+
+class TestTokenizerBackend(unittest.TestCase):
+
+    @unittest.skipIf(MosesTokenizer is None, 'sacremoses is not installed')
+    @unittest.skipIf(which('perl') is None, 'the moses scripts require perl')
+    def test_sacremoses_matches_perl(self):
+        perl_processor = DataProcessor(lang='en', pool_size=1)
+        self.addCleanup(perl_processor.close)
+        sacremoses_processor = DataProcessor(lang='en', tokenizer_backend='sacremoses')
+
+        texts = [u'Hello, world!', u'It\'s 3.5 km (roughly) to the "station".', u'Süß & sauer: 10% off', u'']
+        self.assertEqual(sacremoses_processor.tokenize_batch(texts), perl_processor.tokenize_batch(texts))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(AssertionError):
+            DataProcessor(lang='en', tokenizer_backend='jflex')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+# coding: utf-8
+import unittest
+
+from constrained_decoding.server import convert_token_annotations_to_spans, remap_constraint_indices
+
+
+class TestConvertTokenAnnotationsToSpans(unittest.TestCase):
+
+    def test_convert_token_annotations_to_spans(self):
+        tokens = [u'Das', u'ist', u'ein', u'Ha@@', u'us', u',', u'kein', u'Bo@@', u'ot', u'.']
+        annotations = [None, None, None, (0, 0), (0, 1), None, (1, 0), None, None, None]
+        spans, output_sequence = convert_token_annotations_to_spans(tokens, annotations)
+        self.assertEqual(output_sequence, u'Das ist ein Ha@@ us , kein Bo@@ ot .')
+        self.assertEqual(spans, [[12, 19], [22, 26]])
+
+    def test_constraint_at_start(self):
+        tokens = [u'Haus', u'.']
+        spans, output_sequence = convert_token_annotations_to_spans(tokens, [(0, 0), None])
+        self.assertEqual(output_sequence, u'Haus .')
+        self.assertEqual(spans, [[0, 4]])
+
+
+class TestRemapConstraintIndices(unittest.TestCase):
+
+    def setUp(self):
+        self.tokenized = u'Das ist ein Ha@@ us , kein Bo@@ ot .'
+        self.detokenized = u'Das ist ein Haus, kein Boot.'
+
+    def test_remap_constraint_indices(self):
+        self.assertEqual(remap_constraint_indices(self.tokenized, self.detokenized, [[12, 19], [27, 33]]),
+                         [[12, 16], [23, 26]])
+        self.assertEqual(remap_constraint_indices(self.tokenized, self.detokenized, [[0, 3], [27, 35]]),
+                         [[0, 3], [23, 27]])
+        self.assertEqual(remap_constraint_indices(self.tokenized, self.detokenized, [[12, 19], [22, 26]]),
+                         [[12, 16], [18, 22]])
+
+    def test_constraint_at_end_of_sequence(self):
+        self.assertEqual(remap_constraint_indices(self.tokenized, self.detokenized, [[27, 37]]),
+                         [[23, 28]])
+
+    def test_changed_characters(self):
+        with self.assertRaises(IndexError):
+            remap_constraint_indices(self.tokenized, u'Das ist ein Hausx', [[0, 3]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import os
+import re
+import unittest
+
+import constrained_decoding
+
+
+class TestNoDebuggerCalls(unittest.TestCase):
+    """a leftover breakpoint in the package halts every request to the server"""
+
+    def test_no_debugger_calls(self):
+        debugger_call = re.compile(r'\b(?:i?pdb\.set_trace|breakpoint)\(')
+        package_dir = os.path.dirname(constrained_decoding.__file__)
+
+        offending_lines = []
+        for dirpath, _, filenames in os.walk(package_dir):
+            for filename in filenames:
+                if not filename.endswith(('.py', '.pyx')):
+                    continue
+                path = os.path.join(dirpath, filename)
+                with open(path) as source_file:
+                    for line_no, line in enumerate(source_file, 1):
+                        if debugger_call.search(line):
+                            offending_lines.append('{}:{}: {}'.format(path, line_no, line.strip()))
+
+        self.assertEqual(offending_lines, [], 'Debugger calls found:\n{}'.format('\n'.join(offending_lines)))
+
+
+if __name__ == '__main__':
+    unittest.main()